@@ -1,8 +1,13 @@
 import os
 import shutil
+from concurrent.futures import CancelledError
 from pathlib import Path
+from threading import Event
 import requests
-from typing import Union
+from requests.adapters import HTTPAdapter
+from typing import Dict, Optional, Union
+from urllib3.util.retry import Retry
+from zipfile import BadZipFile, ZipFile
 from tqdm import tqdm
 
 ROOT_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
@@ -10,9 +15,30 @@ DATABASE_FOLDER = os.path.join(ROOT_FOLDER, "database")
 DUCKDB_FILE = os.path.join(DATABASE_FOLDER, "data.duckdb")
 CACHE_FOLDER = os.path.join(ROOT_FOLDER, "database", "cache")
 
+# size of the chunks read from the network and written to disk when downloading files
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# size of the chunks decompressed and written to disk when extracting files from a zip
+EXTRACT_CHUNK_SIZE = 1024 * 1024
+
+# RAM-backed folder (tmpfs) preferred to extract files before loading them in duckdb
+RAM_FOLDER = os.environ.get("RAM_FOLDER", "/dev/shm")
+
 os.makedirs(CACHE_FOLDER, exist_ok=True)
 os.makedirs(DATABASE_FOLDER, exist_ok=True)
 
+# shared http session, so that connections are kept alive and reused between downloads
+http_session = requests.Session()
+http_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=8,
+        pool_maxsize=8,
+        max_retries=Retry(
+            total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]
+        ),
+    ),
+)
+
 # common style for the progressbar dans cli
 tqdm_common = {
     "ncols": 100,
@@ -27,14 +53,56 @@ def clear_cache(recreate_folder: bool = True):
         os.makedirs(CACHE_FOLDER, exist_ok=True)
 
 
-def download_file_from_https(url: str, filepath: Union[str, Path]):
+def get_available_memory() -> int:
+    """
+    Returns the memory currently available on the machine, in bytes.
+    :return: The available memory, 0 if it can't be determined.
+    """
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (AttributeError, ValueError, OSError):
+        return 0
+
+
+def get_extract_folder(file_size: int, memory_limit: int) -> str:
+    """
+    Returns the folder where to extract a file before loading it.
+    The RAM-backed RAM_FOLDER avoids writing the file to disk and reading it back,
+    but the file then takes RAM that duckdb doesn't count in its memory_limit.
+    It is only used when it has room for twice the file, and when the file fits
+    twice in both the available memory and the memory_limit of duckdb, which the caller
+    must lower by the size of the file while it is extracted.
+    Otherwise, CACHE_FOLDER is used.
+    :param file_size: The size of the file to extract, in bytes.
+    :param memory_limit: The memory_limit of duckdb, in bytes.
+    :return: The path to the folder.
+    """
+    if (
+        os.path.isdir(RAM_FOLDER)
+        and shutil.disk_usage(RAM_FOLDER).free > 2 * file_size
+        and get_available_memory() > 2 * file_size
+        and memory_limit > 2 * file_size
+    ):
+        return RAM_FOLDER
+    return CACHE_FOLDER
+
+
+def download_file_from_https(
+    url: str,
+    filepath: Union[str, Path],
+    headers: Optional[Dict[str, str]] = None,
+    cancel_event: Optional[Event] = None,
+):
     """
     Downloads a file from a https link to a local file.
     :param url: The url where to download the file.
     :param filepath: The path to the local file.
+    :param headers: Additional http headers to send with the request.
+    :param cancel_event: When set, e.g. from another thread, the download is stopped
+        after the current chunk and CancelledError is raised.
     :return: Downloaded file filename.
     """
-    response = requests.get(url, stream=True)
+    response = http_session.get(url, stream=True, headers=headers)
     response.raise_for_status()
     response_size = int(response.headers.get("content-length", 0))
     filepath = Path(filepath)
@@ -46,8 +114,42 @@ def download_file_from_https(url: str, filepath: Union[str, Path]):
             desc=f"Processing file {filepath.name}",
             **tqdm_common,
         ) as pbar:
-            for chunk in response.iter_content(chunk_size=8192):
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise CancelledError(f"Download cancelled: {url}")
                 f.write(chunk)
                 pbar.update(len(chunk))
 
     return filepath.name
+
+
+def extract_file_from_zip(
+    zip_ref: ZipFile, filename: str, extract_folder: Union[str, Path]
+) -> str:
+    """
+    Extracts one file from a zip archive, using larger chunks than ZipFile.extract.
+    :param zip_ref: The opened zip archive.
+    :param filename: The name of the file in the archive.
+    :param extract_folder: The folder where to extract the file.
+    :return: The path to the extracted file.
+    """
+    os.makedirs(extract_folder, exist_ok=True)
+    filepath = os.path.join(extract_folder, os.path.basename(filename))
+    with zip_ref.open(filename) as src, open(filepath, "wb") as dst:
+        shutil.copyfileobj(src, dst, length=EXTRACT_CHUNK_SIZE)
+
+    return filepath
+
+
+def check_zip_file(filepath: Union[str, Path]) -> bool:
+    """
+    Checks the integrity of a zip file, e.g. to detect a truncated download.
+    Every member is read and its CRC compared to the one stored in the archive.
+    :param filepath: The path to the zip file.
+    :return: True if the zip file is valid, False if not
+    """
+    try:
+        with ZipFile(filepath, "r") as zip_ref:
+            return zip_ref.testzip() is None
+    except BadZipFile:
+        return False
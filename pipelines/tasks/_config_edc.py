@@ -1,12 +1,15 @@
+from functools import cache
 from typing import Dict
 
 
+@cache
 def get_edc_config() -> Dict:
     """
     Returns various configuration for processing the EDC (Eau distribuée par commune) datasets.
     The data comes from https://www.data.gouv.fr/fr/datasets/resultats-du-controle-sanitaire-de-leau-distribuee-commune-par-commune/
     For each year a dataset is downloadable on a URL like this (ex. 2024):
         https://www.data.gouv.fr/fr/datasets/r/84a67a3b-08a7-4001-98e6-231c74a98139
+    The config is only built once, the same dict is returned on subsequent calls.
     :return: A dict with the config used for processing.
         The "source" part is related to the data.gouv datasource
         The "files" part is related to the extracted files information and sql table names
@@ -15,17 +18,6 @@ def get_edc_config() -> Dict:
     edc_config = {
         "source": {
             "base_url": "https://www.data.gouv.fr/fr/datasets/r/",
-            "available_years": [
-                "2016",
-                "2017",
-                "2018",
-                "2019",
-                "2020",
-                "2021",
-                "2022",
-                "2023",
-                "2024",
-            ],
             "yearly_files_infos": {
                 "2024": {
                     "id": "84a67a3b-08a7-4001-98e6-231c74a98139",
@@ -83,6 +75,10 @@ def get_edc_config() -> Dict:
             },
         },
     }
+    # The available years are derived from the yearly files to avoid maintaining two lists
+    edc_config["source"]["available_years"] = sorted(
+        edc_config["source"]["yearly_files_infos"]
+    )
 
     return edc_config
 
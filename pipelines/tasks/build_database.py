@@ -14,17 +14,28 @@ Examples:
 
 import logging
 import os
-from typing import List, Literal
-from zipfile import ZipFile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+from itertools import islice
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from threading import Event
+from typing import Iterator, List, Literal, Optional, Tuple
+from zipfile import BadZipFile, ZipFile
 
 import duckdb
 
 from ._common import (
     CACHE_FOLDER,
     DUCKDB_FILE,
+    RAM_FOLDER,
     tqdm_common,
+    check_zip_file,
     clear_cache,
     download_file_from_https,
+    extract_file_from_zip,
+    get_extract_folder,
 )
 from ._config_edc import create_edc_yearly_filename, get_edc_config
 from tqdm import tqdm
@@ -33,6 +44,20 @@ from tqdm import tqdm
 logger = logging.getLogger(__name__)
 edc_config = get_edc_config()
 
+# maximum number of yearly files downloaded at the same time from www.data.gouv.fr
+MAX_PARALLEL_DOWNLOADS = 5
+# number of times a yearly file is downloaded before giving up if it is corrupted
+DOWNLOAD_ATTEMPTS = 2
+# units used by duckdb to display memory sizes
+MEMORY_UNITS = {
+    "bytes": 1,
+    "KiB": 2**10,
+    "MiB": 2**20,
+    "GiB": 2**30,
+    "TiB": 2**40,
+    "PiB": 2**50,
+}
+
 
 def check_table_existence(conn: duckdb.DuckDBPyConnection, table_name: str) -> bool:
     """
@@ -41,94 +66,229 @@ def check_table_existence(conn: duckdb.DuckDBPyConnection, table_name: str) -> b
     :param table_name: The table name to check existence
     :return: True if the table exists, False if not
     """
-    query = f"""
-        SELECT COUNT(*)
-        FROM information_schema.tables
-        WHERE table_name = '{table_name}'
+    query = """
+        SELECT EXISTS (
+            SELECT 1
+            FROM information_schema.tables
+            WHERE table_name = ?
+        )
         """
-    conn.execute(query)
-    return list(conn.fetchone())[0] == 1
+    conn.execute(query, [table_name])
+    return conn.fetchone()[0]
 
 
-def download_extract_insert_yearly_edc_data(year: str):
+def get_memory_limit(conn: duckdb.DuckDBPyConnection) -> int:
+    """
+    Returns the memory_limit setting of duckdb
+    :param conn: The duckdb connection to use
+    :return: The memory limit in bytes
     """
-    Downloads from www.data.gouv.fr the EDC (Eau distribuée par commune) dataset for one year,
-    extracts the files and insert the data into duckdb
+    # duckdb returns the setting in a human-readable form, e.g. "4.6 GiB"
+    value, unit = (
+        conn.execute("SELECT current_setting('memory_limit')").fetchone()[0].split()
+    )
+    return int(float(value) * MEMORY_UNITS[unit])
+
+
+@contextmanager
+def extract_folder_for(
+    conn: duckdb.DuckDBPyConnection, year: str, file_size: int
+) -> Iterator[str]:
+    """
+    Creates a temporary folder where to extract a file before loading it in duckdb,
+    removed on exit. When the folder is RAM-backed (see get_extract_folder),
+    the memory_limit of duckdb is lowered by the size of the file until then,
+    so that the extracted file and duckdb together stay within the memory limit.
+    :param conn: The duckdb connection used to load the file
+    :param year: The year of the dataset
+    :param file_size: The size of the file to extract, in bytes
+    :return: The path to the temporary folder
+    """
+    memory_limit = get_memory_limit(conn)
+    extract_root = get_extract_folder(file_size, memory_limit)
+    in_ram = extract_root == RAM_FOLDER
+    if in_ram:
+        conn.execute(f"SET memory_limit = '{memory_limit - file_size}B'")
+    try:
+        with TemporaryDirectory(prefix=f"edc_{year}_", dir=extract_root) as folder:
+            yield folder
+    finally:
+        # The ingestion connection keeps the default memory_limit otherwise
+        if in_ram:
+            conn.execute("RESET memory_limit")
+
+
+def get_yearly_edc_zipfile(year: str) -> str:
+    """
+    Returns the path where the EDC zip file of a year is downloaded
+    :param year: The year of the dataset
+    :return: The path to the zip file in the cache folder
+    """
+    return os.path.join(
+        CACHE_FOLDER, edc_config["source"]["yearly_files_infos"][year]["zipfile"]
+    )
+
+
+def download_yearly_edc_zipfile(year: str, cancel_event: Optional[Event] = None) -> str:
+    """
+    Downloads from www.data.gouv.fr the EDC (Eau distribuée par commune) zip file for one year
+    The download is retried if the zip file is corrupted.
     :param year: The year from which we want to download the dataset
-    :return: Create or replace the associated tables in the duckcb database.
-        It adds the column "de_partition" based on year as an integer.
+    :param cancel_event: When set, the download is stopped (see download_file_from_https)
+    :return: The path to the downloaded zip file
     """
-    # Dataset specific constants
     DATA_URL = (
         edc_config["source"]["base_url"]
         + edc_config["source"]["yearly_files_infos"][year]["id"]
     )
-    ZIP_FILE = os.path.join(
-        CACHE_FOLDER, edc_config["source"]["yearly_files_infos"][year]["zipfile"]
-    )
-    EXTRACT_FOLDER = os.path.join(CACHE_FOLDER, f"raw_data_{year}")
-    FILES = edc_config["files"]
+    ZIP_FILE = get_yearly_edc_zipfile(year)
+
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        logger.info(f"Downloading EDC dataset for {year}...")
+        # The zip file is already compressed, no need for the server to compress it
+        download_file_from_https(
+            url=DATA_URL,
+            filepath=ZIP_FILE,
+            headers={"Accept-Encoding": "identity"},
+            cancel_event=cancel_event,
+        )
+        if check_zip_file(ZIP_FILE):
+            break
+        logger.warning(
+            f"Corrupted zip file for {year} (attempt {attempt}/{DOWNLOAD_ATTEMPTS})"
+        )
+    else:
+        raise BadZipFile(f"Corrupted zip file downloaded from {DATA_URL}")
 
-    logger.info(f"Processing EDC dataset for {year}...")
+    return ZIP_FILE
 
-    download_file_from_https(url=DATA_URL, filepath=ZIP_FILE)
 
-    logger.info("   Extracting files...")
-    with ZipFile(ZIP_FILE, "r") as zip_ref:
-        file_list = zip_ref.namelist()
-        with tqdm(
-            total=len(file_list), unit="file", desc="Extracting", **tqdm_common
-        ) as pbar:
-            for file in file_list:
-                zip_ref.extract(file, EXTRACT_FOLDER)  # Extract each file
-                pbar.update(1)
+def download_edc_zipfiles(years: List[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Downloads concurrently the EDC zip files of several years.
+    The zip files are yielded in the order of the years as soon as they are downloaded,
+    so that the caller can process one year while the next ones are still downloading.
+    At most MAX_PARALLEL_DOWNLOADS years are downloaded ahead of the caller.
+    If a download fails or the iterator is closed early, the error is raised without
+    waiting for the other downloads: the queued ones are cancelled, the running ones
+    are stopped after their current chunk, and the zip files left behind are removed.
+    :param years: The years from which we want to download the datasets
+    :return: An iterator of (year, path to the downloaded zip file)
+    """
+    executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_DOWNLOADS)
+    cancel_event = Event()
+    pending = deque()
+    years_to_download = iter(years)
+    year = None
+
+    def submit_downloads(n: int):
+        for next_year in islice(years_to_download, n):
+            future = executor.submit(
+                download_yearly_edc_zipfile, next_year, cancel_event
+            )
+            pending.append((next_year, future))
+
+    try:
+        submit_downloads(MAX_PARALLEL_DOWNLOADS)
+        while pending:
+            year, future = pending.popleft()
+            zip_file = future.result()
+            # Start the download of the next year before handing over this one
+            submit_downloads(1)
+            yield year, zip_file
+    finally:
+        cancel_event.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+        # The caller removes each zip file once processed: only the current one
+        # may remain if its processing failed, and the pending ones once downloaded
+        if year is not None:
+            Path(get_yearly_edc_zipfile(year)).unlink(missing_ok=True)
+        for pending_year, future in pending:
+            zip_file = Path(get_yearly_edc_zipfile(pending_year))
+            future.add_done_callback(lambda _, f=zip_file: f.unlink(missing_ok=True))
+
+
+def extract_insert_yearly_edc_data(
+    conn: duckdb.DuckDBPyConnection, year: str, zip_file: str
+):
+    """
+    Extracts the files of a downloaded EDC (Eau distribuée par commune) zip file
+    and insert the data into duckdb.
+    Each file is extracted right before being inserted and removed right after,
+    in a RAM-backed folder when possible (see extract_folder_for).
+    The data of the year is inserted in a single transaction.
+    :param conn: The duckdb connection to use
+    :param year: The year of the dataset
+    :param zip_file: The path to the downloaded zip file
+    :return: Create or replace the associated tables in the duckcb database.
+        It adds the column "de_partition" based on year as an integer.
+    """
+    # Dataset specific constants
+    FILES = edc_config["files"]
 
-    logger.info("   Creating or updating tables in the database...")
-    conn = duckdb.connect(DUCKDB_FILE)
+    logger.info(f"Processing EDC dataset for {year}...")
 
-    total_operations = len(FILES)
-    with tqdm(
-        total=total_operations, unit="operation", desc="Handling", **tqdm_common
-    ) as pbar:
-        for file_info in FILES.values():
-            filepath = os.path.join(
-                EXTRACT_FOLDER,
-                create_edc_yearly_filename(
+    logger.info("   Creating or updating tables in the database...")
+    conn.execute("BEGIN TRANSACTION")
+    try:
+        total_operations = len(FILES)
+        with (
+            ZipFile(zip_file, "r") as zip_ref,
+            tqdm(
+                total=total_operations, unit="operation", desc="Handling", **tqdm_common
+            ) as pbar,
+        ):
+            for file_info in FILES.values():
+                filename = create_edc_yearly_filename(
                     file_name_prefix=file_info["file_name_prefix"],
                     file_extension=file_info["file_extension"],
                     year=year,
-                ),
-            )
+                )
+
+                table_name = file_info["table_name"]
+                staging_table_name = f"{table_name}_staging"
 
-            if check_table_existence(
-                conn=conn, table_name=f"{file_info['table_name']}"
-            ):
+                # The file is first loaded into a staging table, so that the data
+                # of the year is only replaced once the new data has been read
                 query = f"""
-                    DELETE FROM {f"{file_info['table_name']}"}
-                    WHERE de_partition = CAST({year} as INTEGER)
-                    ;
+                    CREATE OR REPLACE TEMP TABLE {staging_table_name} AS
+                    SELECT
+                        *,
+                        CAST($year AS INTEGER) AS de_partition,
+                        current_date           AS de_ingestion_date
+                    FROM read_csv($filepath, header=true, delim=',');
                 """
-                conn.execute(query)
-                query_start = f"INSERT INTO {f'{file_info["table_name"]}'} "
-
-            else:
-                query_start = f"CREATE TABLE {f'{file_info["table_name"]}'} AS "
-
-            query_select = f"""
-                SELECT 
-                    *,
-                    CAST({year} AS INTEGER) AS de_partition,
-                    current_date            AS de_ingestion_date
-                FROM read_csv('{filepath}', header=true, delim=',');
-            """
-
-            conn.execute(query_start + query_select)
-            pbar.update(1)
+                file_size = zip_ref.getinfo(filename).file_size
+                with extract_folder_for(conn, year, file_size) as extract_folder:
+                    filepath = extract_file_from_zip(zip_ref, filename, extract_folder)
+                    conn.execute(query, {"year": year, "filepath": filepath})
+
+                if check_table_existence(conn=conn, table_name=table_name):
+                    query = f"""
+                        DELETE FROM {table_name}
+                        WHERE de_partition = CAST($year as INTEGER)
+                        ;
+                    """
+                    conn.execute(query, {"year": year})
+                    query_start = f"INSERT INTO {table_name} BY NAME "
+
+                else:
+                    query_start = f"CREATE TABLE {table_name} AS "
+
+                conn.execute(query_start + f"SELECT * FROM {staging_table_name};")
+                conn.execute(f"DROP TABLE {staging_table_name};")
+                pbar.update(1)
 
-    conn.close()
+        conn.execute("COMMIT")
+    except Exception:
+        # Leave the tables as they were, the staging tables are rolled back too
+        conn.execute("ROLLBACK")
+        raise
 
+    # Only remove this year's files: the zip files of the other years
+    # may still be waiting in the cache folder
     logger.info("   Cleaning up cache...")
-    clear_cache()
+    os.remove(zip_file)
 
     return True
 
@@ -193,8 +353,14 @@ def process_edc_datasets(
     if drop_tables or (refresh_type == "all"):
         drop_edc_tables()
 
-    for year in years_to_update:
-        download_extract_insert_yearly_edc_data(year=year)
+    with duckdb.connect(DUCKDB_FILE) as conn:
+        # The parallel csv reader doesn't need to keep the rows of the files in order,
+        # which reduces memory usage and speeds up the insertion of large files
+        conn.execute("SET preserve_insertion_order = false")
+        # closing() stops the pending downloads as soon as a year fails
+        with closing(download_edc_zipfiles(years=years_to_update)) as zip_files:
+            for year, zip_file in zip_files:
+                extract_insert_yearly_edc_data(conn=conn, year=year, zip_file=zip_file)
 
     logger.info("Cleaning up cache...")
     clear_cache(recreate_folder=False)